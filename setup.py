@@ -12,7 +12,7 @@ setup(
     url="https://github.com/kshpytsya/nomad-sync-job-dispatch",
     setup_requires=["setuptools_scm"],
     use_scm_version=True,
-    python_requires=">=3.7, <3.8",
+    python_requires=">=3.11",
     packages=find_packages(where="src"),
     package_dir={"": "src"},
     entry_points={
@@ -28,12 +28,17 @@ setup(
         "Operating System :: MacOS :: MacOS X",
         "Operating System :: Microsoft :: Windows",
         "Operating System :: POSIX",
-        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3.11",
+        "Programming Language :: Python :: 3.12",
         "Topic :: System :: Systems Administration",
     ],
     install_requires=[
+        "aiohttp>=3.8.3,<4",
         "click>=7.0,<8",
         "click-log>=0.3.2,<1",
+        "orjson>=3.8,<4",
+        "pybase64>=1.2.3,<2",
         "python-nomad>=1.1.0,<2",
+        "requests>=2.20,<3",
     ],
 )
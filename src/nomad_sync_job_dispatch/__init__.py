@@ -1,4 +1,6 @@
+import importlib.metadata
+
 try:
-    __version__ = __import__('pkg_resources').get_distribution(__name__).version
-except:  # noqa # pragma: no cover
+    __version__ = importlib.metadata.version(__name__)
+except importlib.metadata.PackageNotFoundError:  # pragma: no cover
     pass
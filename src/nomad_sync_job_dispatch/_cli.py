@@ -1,19 +1,63 @@
-import base64
-import json
+import asyncio
+import atexit
+import concurrent.futures
+import contextlib
+import io
 import logging
+import math
+import os
+import signal
+import ssl
 import sys
 import threading
 import time
 import typing as tp
 
+import aiohttp
 import click
 import click_log
 import nomad
+import requests
+from orjson import JSONDecodeError
+from orjson import loads as json_loads
+from pybase64 import b64decode
+from pybase64 import b64encode
+from urllib3.util.retry import Retry
 
 
 logger = logging.getLogger(__name__)
 click_log.basic_config(logger)
 
+# per https://www.nomadproject.io/api/jobs.html#payload the encoded payload is
+# limited to 15KB, and base64 encodes every 3 bytes with 4 characters
+MAX_PAYLOAD_SIZE = 15 * 1024 // 4 * 3
+
+# per https://www.nomadproject.io/api/index.html#blocking-queries
+BLOCKING_QUERY_WAIT = 300.0
+# retries of connection failures by the python-nomad session
+REQUEST_RETRIES = 3
+REQUEST_RETRY_BACKOFF = 0.1
+LOG_STREAM_READ_TIMEOUT = 60.0
+TERMINAL_CLIENT_STATUSES = frozenset(["complete", "failed", "lost"])
+
+
+class NomadApiError(Exception):
+    pass
+
+
+class NomadTimeoutError(NomadApiError):
+    pass
+
+
+class NomadConnectionError(NomadApiError):
+    pass
+
+
+class StopSignalReceived(Exception):
+    def __init__(self, signum: int) -> None:
+        super().__init__(signum)
+        self.signum = signum
+
 
 def main() -> None:
     try:
@@ -29,16 +73,15 @@ def main() -> None:
 def validate_meta(
     ctx: tp.Any,
     param: tp.Any,
-    values: tp.Tuple[str, ...],
-) -> tp.Dict[str, str]:
-    result = {}
-
-    for value in values:
-        fields = value.split("=", 1)
-        if len(fields) != 2:
-            raise click.BadParameter("must be in form of \"key=value\"")
+    values: tuple[str, ...],
+) -> dict[str, str]:
+    try:
+        result = dict(value.split("=", 1) for value in values)
+    except ValueError:
+        raise click.BadParameter("must be in form of \"key=value\"")
 
-        result[fields[0]] = fields[1]
+    if len(result) != len(values):
+        raise click.BadParameter("keys must not be repeated")
 
     return result
 
@@ -102,9 +145,9 @@ def validate_meta(
     "--alloc-timeout-step",
     metavar="<sec>",
     type=float,
-    show_default=True,
     default=2.0,
-    help="Job allocation polling interval.",
+    hidden=True,
+    help="Ignored. Kept for compatibility, allocation is now awaited with a blocking query.",
 )
 @click.option(
     "--task",
@@ -123,15 +166,15 @@ def validate_meta(
     type=float,
     show_default=True,
     default=2.0,
-    help="Log polling interval.",
+    help="Delay before reconnecting a log stream closed by Nomad.",
 )
 @click.option(
     "--alloc-poll-interval",
     metavar="<sec>",
     type=float,
-    show_default=True,
     default=2.0,
-    help="Allocation status polling interval.",
+    hidden=True,
+    help="Ignored. Kept for compatibility, allocation status is now watched with a blocking query.",
 )
 @click.argument("job", nargs=1)
 @click.argument(
@@ -152,18 +195,18 @@ def root(**opts: tp.Any) -> None:
     a signal.
     """
 
-    payload_b64: tp.Optional[bytes]
+    payload_b64: str | None
 
     if opts["input"] is not None:
         payload = opts["input"].read()
-        # per https://www.nomadproject.io/api/jobs.html#payload
-        payload_b64 = base64.b64encode(payload)
-        if len(payload_b64) > 15 * 1024:
+        if len(payload) > MAX_PAYLOAD_SIZE:
             raise click.BadParameter("encoded payload size exceeds permitted 15KB.")
+
+        payload_b64 = b64encode(payload).decode()
     else:
         payload_b64 = None
 
-    nomad_opts: tp.Dict[str, tp.Any] = {}
+    nomad_opts: dict[str, tp.Any] = {}
 
     for cli_opt_name, nomad_opt_name in [
         ("address", "address"),
@@ -177,6 +220,7 @@ def root(**opts: tp.Any) -> None:
             nomad_opts[nomad_opt_name] = opt_value
 
     nomad_api = nomad.Nomad(**nomad_opts)
+    share_session(nomad_api)
 
     try:
         dispatch_job_resp = nomad_api.job.dispatch_job(opts["job"], meta=opts["meta"], payload=payload_b64)
@@ -189,146 +233,515 @@ def root(**opts: tp.Any) -> None:
     dispatched_job_eval_id = dispatch_job_resp["EvalID"]
 
     try:
-        def wait_for_alloc() -> tp.List[tp.Any]:
-            deadline = time.time() + opts["alloc_timeout"]
-            while True:
-                remaining = deadline - time.time()
-                if remaining < 0:
-                    raise click.ClickException("timed out waiting for allocation to be created")
+        allocation_client_status = asyncio.run(monitor(nomad_api, dispatched_job_eval_id, opts))
 
-                try:
-                    allocations = nomad_api.evaluation.get_allocations(dispatched_job_eval_id)
-                except nomad.api.exceptions.BaseNomadException as e:
-                    raise click.ClickException(f"failed getting evaluation allocations: {e.nomad_resp.text}")
+        if allocation_client_status != "complete":
+            sys.exit(1)
+    except StopSignalReceived as e:
+        logger.error("interrupted by %s", signal.Signals(e.signum).name)
+        # mimic the exit status of a process killed by the signal
+        sys.exit(128 + e.signum)
+    finally:
+        deregister_job_in_background(nomad_api, dispatched_job_id)
 
-                if allocations:
-                    assert isinstance(allocations, list)
-                    if all(i.get("TaskStates") for i in allocations):
-                        return allocations
 
-                logger.debug(f"waiting for allocation to appear, {remaining:1.0f}s remaining till deadline")
-                time.sleep(min(remaining, opts["alloc_timeout_step"]))
+def deregister_job_in_background(nomad_api: nomad.Nomad, job_id: str) -> None:
+    """
+    Deregister the job in a background thread, which the process waits for on exit
+    for as long as the request and all its retries may take, but no longer.
+    """
 
-        allocations = wait_for_alloc()
-        if len(allocations) != 1:
-            raise click.ClickException(f"expected a single allocation to appear, but got {len(allocations)}")
+    def deregister() -> None:
+        try:
+            nomad_api.job.deregister_job(job_id)
+        except nomad.api.exceptions.BaseNomadException as e:
+            logger.error("failed to deregister dispatched job: %s", e.nomad_resp.text)
 
-        allocation = allocations[0]
-        allocation_id = allocation["ID"]
+    # daemon, as otherwise the interpreter would wait for it without any timeout
+    # before even getting to atexit handlers
+    thread = threading.Thread(target=deregister, name="deregister", daemon=True)
+    thread.start()
 
-        logger.debug(f"got allocation {allocation_id}")
+    # every attempt may take up to the request timeout, and urllib3 sleeps
+    # backoff * 2 ** (n - 1) before the n-th retry, if at all
+    deregister_timeout = (REQUEST_RETRIES + 1) * nomad_api.timeout + sum(
+        REQUEST_RETRY_BACKOFF * 2 ** i for i in range(REQUEST_RETRIES)
+    )
 
-        if opts["task"]:
-            tasks_to_monitor = []
-            for i in opts["task"]:
-                if i not in allocation["TaskStates"]:
-                    raise click.ClickException(f"task \"{i}\" is not found")
-                tasks_to_monitor.append(i)
-        else:
-            tasks_to_monitor = sorted(allocation["TaskStates"])
+    def wait_for_deregister() -> None:
+        thread.join(deregister_timeout)
+        if thread.is_alive():
+            logger.warning(
+                "deregistering dispatched job %s did not complete in %.1fs, it may still be registered",
+                job_id,
+                deregister_timeout,
+            )
+
+    atexit.register(wait_for_deregister)
+
+
+def share_session(nomad_api: nomad.Nomad) -> None:
+    """
+    python-nomad creates a separate requests.Session for every API endpoint.
+    Make them all use a single one so that connections are reused between calls.
+    """
+
+    # note: only idempotent methods are retried, so dispatch is never repeated
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=16,
+        max_retries=Retry(total=REQUEST_RETRIES, backoff_factor=REQUEST_RETRY_BACKOFF),
+    )
 
-        if opts["prefix_task"]:
-            max_task_name_len = max(len(i) for i in tasks_to_monitor)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    for requester in vars(nomad_api).values():
+        if isinstance(requester, nomad.api.base.Requester):
+            requester.session = session
+
+
+def split_frames(data: bytes) -> tuple[list[tp.Any], bytes]:
+    """
+    Decode all complete log stream frames at the start of data and return them
+    along with the remaining incomplete data.
+
+    Frames are flat JSON objects sent back to back, so each of them ends at a "}"
+    which is not a part of a string value.
+    """
+
+    frames = []
+    start = 0
+    end = data.find(b"}")
+
+    while end >= 0:
+        try:
+            frames.append(json_loads(data[start:end + 1]))
+        except JSONDecodeError:
+            pass
         else:
-            max_task_name_len = 0
+            start = end + 1
 
-        line_buffering = len(tasks_to_monitor) > 1
-        threads = []
-        stop_streaming = threading.Event()
+        end = data.find(b"}", end + 1)
 
-        def streaming_func(task: str, log_type: int) -> None:
-            offset = 0
-            log_poll_interval = opts["log_poll_interval"]
-            type_str = ["stdout", "stderr"][log_type]
-            dest_fd = [sys.stdout, sys.stderr][log_type]
-            tail = b""
+    return frames, data[start:]
 
-            if max_task_name_len:
-                line_prefix = f"{task:{max_task_name_len}}:".encode()
-            else:
-                line_prefix = b""
 
-            stop_on_empty_response = False
+def make_output(dest: tp.TextIO) -> tp.Callable[[bytes], None]:
+    """
+    Return a thread safe function writing bytes straight to the file descriptor
+    of dest, bypassing Python's buffering. If dest has no file descriptor, e.g.
+    because it was replaced to capture the output, write through its buffer instead.
+    """
 
-            while True:
-                try:
-                    response = nomad_api.client.stream_logs.stream(
-                        id=allocation_id,
-                        task=task,
-                        offset=offset,
-                        type=type_str,
-                    )
-                except nomad.api.exceptions.BaseNomadException as e:
-                    logger.error(
-                        f"log streaming failed (alloc={allocation_id}, task={task}, type={type_str}): "
-                        f"{e.nomad_resp.text}",
-                    )
-                    break
-
-                if response:
-                    parsed_response = json.loads(response)
-                    data = base64.b64decode(parsed_response["Data"])
+    try:
+        fd = dest.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        def write_buffered(data: bytes) -> None:
+            dest.buffer.write(data)
+            dest.flush()
 
-                    if line_prefix or line_buffering:
-                        for line in (tail + data).splitlines(keepends=True):
-                            if line.endswith(b"\n"):
-                                dest_fd.buffer.write(line_prefix)
-                                dest_fd.buffer.write(line)
-                            else:
-                                tail = line
-                    else:
-                        dest_fd.buffer.write(data)
-
-                    dest_fd.flush()
-                    offset = parsed_response["Offset"]
-                else:
-                    if stop_on_empty_response:
-                        break
+        return write_buffered
 
-                if not stop_on_empty_response:
-                    if stop_streaming.wait(log_poll_interval):
-                        stop_on_empty_response = True
+    # anything written through dest so far must come out first
+    dest.flush()
+    lock = threading.Lock()
 
-            if tail:
-                # Note: it appears that Nomad always adds a trailing "\n" at the end of log
-                # be let us not rely on that
-                dest_fd.buffer.write(line_prefix)
-                dest_fd.buffer.write(tail)
-                dest_fd.buffer.write(b"\n")
+    def write_fd(data: bytes) -> None:
+        view = memoryview(data)
+        with lock:
+            while view:
+                view = view[os.write(fd, view):]
 
-        for task_to_monitor in tasks_to_monitor:
-            for log_type in [0, 1]:
-                threads.append(threading.Thread(target=streaming_func, args=(task_to_monitor, log_type)))
+    return write_fd
 
-        for thread in threads:
-            thread.start()
 
-        alloc_poll_interval = opts["alloc_poll_interval"]
+def make_ssl_context(nomad_api: nomad.Nomad) -> ssl.SSLContext | bool:
+    # mimic python-nomad, which does not verify certificates unless asked to
+    if not nomad_api.verify and not nomad_api.cert:
+        return False
 
-        while True:
-            try:
-                # TODO find a way to use "blocking query" mechaninsm which
-                # doesn't seem to be directly supported by python-nomad
-                allocation_status = nomad_api.allocation.get_allocation(allocation_id)
-            except nomad.api.exceptions.BaseNomadException as e:
-                raise click.ClickException(f"failed getting allocation status: {e.nomad_resp.text}")
+    context = ssl.create_default_context()
+    if not nomad_api.verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
 
-            allocation_client_status = allocation_status["ClientStatus"]
-            if allocation_client_status in ["complete", "failed", "lost"]:
-                break
+    if nomad_api.cert:
+        context.load_cert_chain(*nomad_api.cert)
 
-            time.sleep(alloc_poll_interval)
+    return context
 
-        logger.debug("allocation complete with status \"%s\", stopping streaming threads", allocation_client_status)
-        stop_streaming.set()
 
-        for thread in threads:
-            thread.join()
+async def monitor(nomad_api: nomad.Nomad, eval_id: str, opts: dict[str, tp.Any]) -> str:
+    """
+    Wait for the allocation of the dispatched job to appear, stream logs of
+    its tasks until it terminates and return its final client status.
 
-        if allocation_client_status != "complete":
-            sys.exit(1)
-    finally:
+    All Nomad requests are issued concurrently from a single event loop over
+    one pooled aiohttp session.
+    """
+
+    loop = asyncio.get_running_loop()
+
+    main_task = asyncio.current_task()
+    assert main_task is not None
+    stop_signals = [signal.SIGINT, signal.SIGTERM]
+    stop_signum: int | None = None
+
+    def on_stop_signal(signum: int) -> None:
+        nonlocal stop_signum
+
+        logger.debug("got signal %s, stopping", signal.Signals(signum).name)
+        stop_signum = signum
+        # repeated signal gets the default treatment
+        for stop_signal in stop_signals:
+            loop.remove_signal_handler(stop_signal)
+
+        main_task.cancel()
+
+    # cancelling the whole monitoring lets all of it wind down at once and then
+    # the job gets deregistered, rather than only a KeyboardInterrupt somewhere
+    # in the main thread, or nothing at all in case of SIGTERM
+    for stop_signal in stop_signals:
         try:
-            nomad_api.job.deregister_job(dispatched_job_id)
-        except nomad.api.exceptions.BaseNomadException as e:
-            logger.error("failed to deregister dispatched job: %s", e.nomad_resp.text)
+            loop.add_signal_handler(stop_signal, on_stop_signal, stop_signal)
+        except NotImplementedError:
+            # e.g. on Windows
+            break
+
+    api_url = nomad_api.address or f"{nomad_api.get_uri()}:{nomad_api.port}"
+
+    common_params: dict[str, str] = {}
+    if nomad_api.get_namespace():
+        common_params["namespace"] = nomad_api.get_namespace()
+    if nomad_api.region:
+        common_params["region"] = nomad_api.region
+
+    headers: dict[str, str] = {}
+    if nomad_api.token:
+        headers["X-Nomad-Token"] = nomad_api.token
+
+    connector = aiohttp.TCPConnector(limit=0, keepalive_timeout=60, ssl=make_ssl_context(nomad_api))
+    timeout = aiohttp.ClientTimeout(total=nomad_api.timeout)
+
+    # dedicated executors, so that writes to a slow consumer of our output hold up
+    # neither the default one, which aiohttp also uses for DNS resolution, nor writes
+    # to the other destination. Writes to a destination are serialized anyway, so a
+    # single thread per destination is enough.
+    output_executors = {
+        type_str: concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=type_str)
+        for type_str in ["stdout", "stderr"]
+    }
+
+    try:
+        async with aiohttp.ClientSession(connector=connector, headers=headers, timeout=timeout) as session:
+            @contextlib.asynccontextmanager
+            async def nomad_request(
+                path: str,
+                timeout: aiohttp.ClientTimeout | None = None,
+                **params: str,
+            ) -> tp.AsyncIterator[aiohttp.ClientResponse]:
+                try:
+                    async with session.get(
+                        f"{api_url}/{nomad_api.version}/{path}",
+                        params={**common_params, **params},
+                        timeout=timeout or session.timeout,
+                    ) as response:
+                        if response.status != 200:
+                            raise NomadApiError((await response.read()).decode(errors="replace"))
+
+                        yield response
+                except TimeoutError:
+                    raise NomadTimeoutError("request timed out")
+                except aiohttp.ClientError as e:
+                    raise NomadConnectionError(str(e) or type(e).__name__)
+
+            async def nomad_get(
+                path: str,
+                timeout: aiohttp.ClientTimeout | None = None,
+                **params: str,
+            ) -> tuple[bytes, tp.Mapping[str, str]]:
+                async with nomad_request(path, timeout, **params) as response:
+                    return await response.read(), response.headers
+
+            async def nomad_watch(path: str, index: int, wait: float = BLOCKING_QUERY_WAIT) -> tuple[tp.Any, int]:
+                """
+                Perform a blocking query, which returns as soon as the resource
+                changes past the given index or the wait time elapses.
+                Returns the decoded response and the index to pass on the next call.
+                Raises NomadTimeoutError if no response arrives in time, in which case
+                the query may be retried with the same index.
+                """
+
+                # Nomad adds up to wait/16 of random jitter to the wait time
+                timeout = aiohttp.ClientTimeout(total=wait * 17 / 16 + nomad_api.timeout)
+
+                # Nomad takes a zero wait for its default of 5 minutes
+                wait_ms = max(1, math.ceil(wait * 1000))
+                body, headers = await nomad_get(path, timeout, index=str(index), wait=f"{wait_ms}ms")
+
+                new_index = int(headers.get("X-Nomad-Index", index))
+                if new_index < index:
+                    # index went backwards, e.g. after a leader change
+                    new_index = 0
+
+                return json_loads(body), new_index
+
+            async def wait_for_alloc() -> tuple[list[tp.Any], int]:
+                deadline = time.monotonic() + opts["alloc_timeout"]
+                index = 0
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining < 0:
+                        raise click.ClickException("timed out waiting for allocation to be created")
+
+                    try:
+                        allocations, index = await nomad_watch(f"evaluation/{eval_id}/allocations", index, remaining)
+                    except NomadTimeoutError:
+                        logger.debug("evaluation allocations query timed out")
+                        continue
+                    except NomadApiError as e:
+                        raise click.ClickException(f"failed getting evaluation allocations: {e}")
+
+                    if allocations:
+                        assert isinstance(allocations, list)
+                        if all(i.get("TaskStates") for i in allocations):
+                            return allocations, index
+
+                    logger.debug(f"waiting for allocation to appear, {remaining:1.0f}s remaining till deadline")
+
+            allocations, allocations_index = await wait_for_alloc()
+            if len(allocations) != 1:
+                raise click.ClickException(f"expected a single allocation to appear, but got {len(allocations)}")
+
+            allocation = allocations[0]
+            allocation_id = allocation["ID"]
+
+            logger.debug(f"got allocation {allocation_id}")
+
+            if opts["task"]:
+                tasks_to_monitor = []
+                for i in opts["task"]:
+                    if i not in allocation["TaskStates"]:
+                        raise click.ClickException(f"task \"{i}\" is not found")
+                    tasks_to_monitor.append(i)
+            else:
+                tasks_to_monitor = sorted(allocation["TaskStates"])
+
+            if opts["prefix_task"]:
+                max_task_name_len = max(len(i) for i in tasks_to_monitor)
+                line_prefixes = {i: f"{i:{max_task_name_len}}:".encode() for i in tasks_to_monitor}
+            else:
+                line_prefixes = dict.fromkeys(tasks_to_monitor, b"")
+
+            # everything that is constant for a particular stream is computed once
+            # outputs are shared by all tasks, as each of them serializes writes to its destination
+            stdout_output = make_output(sys.stdout)
+            stderr_output = make_output(sys.stderr)
+            stream_configs = [
+                (task_to_monitor, line_prefixes[task_to_monitor], type_str, output, output_executors[type_str])
+                for task_to_monitor in tasks_to_monitor
+                for type_str, output in [("stdout", stdout_output), ("stderr", stderr_output)]
+            ]
+
+            line_buffering = len(tasks_to_monitor) > 1
+            log_poll_interval = opts["log_poll_interval"]
+            idle_stderr_reconnect_delay = max(log_poll_interval * 4, 8.0)
+            # Nomad sends heartbeat frames on idle streams, so a stream which stays silent
+            # for that long is presumed dead and is reopened
+            follow_timeout = aiohttp.ClientTimeout(
+                total=None,
+                sock_connect=nomad_api.timeout,
+                sock_read=LOG_STREAM_READ_TIMEOUT,
+            )
+            stop_streaming = asyncio.Event()
+
+            async def stop_streaming_within(timeout: float) -> bool:
+                try:
+                    async with asyncio.timeout(timeout):
+                        await stop_streaming.wait()
+                except TimeoutError:
+                    return False
+
+                return True
+
+            async def stream(
+                task: str,
+                line_prefix: bytes,
+                type_str: str,
+                output: tp.Callable[[bytes], None],
+                output_executor: concurrent.futures.Executor,
+            ) -> None:
+                offset = 0
+                tail = b""
+
+                # runs in an executor thread so that a slow consumer of our output
+                # does not stall the event loop
+                newline_prefix = b"\n" + line_prefix
+
+                def write(data: bytes) -> None:
+                    nonlocal tail
+
+                    if line_prefix or line_buffering:
+                        data = tail + data
+                        complete_len = data.rfind(b"\n") + 1
+                        data, tail = data[:complete_len], data[complete_len:]
+
+                        if line_prefix and data:
+                            # data ends with a newline, which must not be followed by a prefix
+                            data = line_prefix + data[:-1].replace(b"\n", newline_prefix) + b"\n"
+
+                    if data:
+                        output(data)
+
+                async def emit(frames_data: bytes) -> bytes:
+                    """
+                    Output data of all complete frames and return the unparsed remainder.
+                    """
+
+                    nonlocal offset
+
+                    frames, rest = split_frames(frames_data)
+                    data = b"".join([b64decode(i["Data"], validate=False) for i in frames if "Data" in i])
+                    if data:
+                        await loop.run_in_executor(output_executor, write, data)
+
+                    for frame in reversed(frames):
+                        if "Offset" in frame:
+                            offset = frame["Offset"]
+                            break
+
+                    return rest
+
+                def log_params(follow: bool) -> dict[str, str]:
+                    return {
+                        "task": task,
+                        "type": type_str,
+                        "offset": str(offset),
+                        "origin": "start",
+                        "plain": "false",
+                        "follow": "true" if follow else "false",
+                    }
+
+                async def follow() -> bool:
+                    """
+                    Output frames as they arrive on a followed log stream.
+                    Return True if streaming was stopped and False if the stream
+                    was closed by Nomad.
+                    """
+
+                    stopped = asyncio.create_task(stop_streaming.wait())
+                    read: asyncio.Task[bytes] | None = None
+
+                    try:
+                        async with nomad_request(logs_path, follow_timeout, **log_params(True)) as response:
+                            buffer = b""
+
+                            while True:
+                                # rather than cancelling the whole coroutine, only the read is
+                                # cancelled, so that received frames are never partially accounted for
+                                read = asyncio.create_task(response.content.readany())
+                                await asyncio.wait([read, stopped], return_when=asyncio.FIRST_COMPLETED)
+                                if not read.done():
+                                    return True
+
+                                chunk = read.result()
+                                if not chunk:
+                                    return False
+
+                                buffer = await emit(buffer + chunk)
+                    except (NomadTimeoutError, NomadConnectionError) as e:
+                        # reopened from the offset of the last complete frame, so nothing is lost
+                        logger.debug(
+                            f"log stream interrupted (alloc={allocation_id}, task={task}, type={type_str}): {e}",
+                        )
+                        return False
+                    finally:
+                        stopped.cancel()
+                        if read is not None:
+                            read.cancel()
+
+                logs_path = f"client/fs/logs/{allocation_id}"
+
+                try:
+                    while not stop_streaming.is_set() and not await follow():
+                        # many tasks never write to stderr, so until it turns out otherwise
+                        # (i.e. offset has moved), do not hurry reopening its stream
+                        if type_str == "stderr" and not offset:
+                            reconnect_delay = idle_stderr_reconnect_delay
+                        else:
+                            reconnect_delay = log_poll_interval
+
+                        if await stop_streaming_within(reconnect_delay):
+                            break
+
+                    # fetch whatever has been logged after the last frame received
+                    while True:
+                        last_offset = offset
+                        response, _ = await nomad_get(logs_path, None, **log_params(False))
+                        await emit(response)
+                        if offset == last_offset:
+                            break
+                except NomadApiError as e:
+                    logger.error(f"log streaming failed (alloc={allocation_id}, task={task}, type={type_str}): {e}")
+
+                if tail:
+                    # Note: it appears that Nomad always adds a trailing "\n" at the end of log
+                    # be let us not rely on that
+                    await loop.run_in_executor(output_executor, output, line_prefix + tail + b"\n")
+
+            async def watch_alloc(index: int) -> str:
+                while True:
+                    try:
+                        allocation_status, index = await nomad_watch(f"allocation/{allocation_id}", index)
+                    except NomadTimeoutError:
+                        logger.debug("allocation status query timed out, retrying")
+                        continue
+                    except NomadApiError as e:
+                        raise click.ClickException(f"failed getting allocation status: {e}")
+
+                    allocation_client_status: str = allocation_status["ClientStatus"]
+                    if allocation_client_status in TERMINAL_CLIENT_STATUSES:
+                        break
+
+                logger.debug("allocation complete with status \"%s\", stopping log streaming", allocation_client_status)
+                stop_streaming.set()
+
+                return allocation_client_status
+
+            allocation_client_status = allocation["ClientStatus"]
+            if allocation_client_status in TERMINAL_CLIENT_STATUSES:
+                # e.g. a short job which finished while its allocation was being awaited,
+                # so there is nothing to follow and streams will only fetch what was logged
+                logger.debug("allocation already complete with status \"%s\"", allocation_client_status)
+                stop_streaming.set()
+
+            streams = [asyncio.create_task(stream(*stream_config)) for stream_config in stream_configs]
+
+            try:
+                if not stop_streaming.is_set():
+                    # allocations of an evaluation and a single allocation share the index,
+                    # so there is no need to fetch the allocation which we already have
+                    allocation_client_status = await watch_alloc(allocations_index)
+
+                await asyncio.gather(*streams)
+            finally:
+                # in case of an error or a signal, do not leave streams running
+                # against a session which is about to be closed
+                for i in streams:
+                    i.cancel()
+
+                await asyncio.gather(*streams, return_exceptions=True)
+
+            return allocation_client_status
+    except asyncio.CancelledError:
+        if stop_signum is None:
+            raise
+
+        raise StopSignalReceived(stop_signum) from None
+    finally:
+        # all writes have completed by now unless monitoring is being aborted,
+        # in which case there is no point in waiting for them
+        for output_executor in output_executors.values():
+            output_executor.shutdown(wait=False, cancel_futures=True)